@@ -19,6 +19,9 @@ export function useDirectStream(url = 'ws://localhost:8000/ws') {
 
             console.log("🔌 Connecting to Direct Mode WS:", url);
             const ws = new WebSocket(url);
+            // The worker sends transcriptions as binary UTF-8 JSON frames
+            ws.binaryType = 'arraybuffer';
+            const decoder = new TextDecoder();
 
             ws.onopen = () => {
                 console.log("✅ Direct Mode WS Connected");
@@ -40,7 +43,8 @@ export function useDirectStream(url = 'ws://localhost:8000/ws') {
 
             ws.onmessage = (event) => {
                 try {
-                    const data = JSON.parse(event.data);
+                    const raw = typeof event.data === 'string' ? event.data : decoder.decode(event.data);
+                    const data = JSON.parse(raw);
                     if (data.type === 'transcription') {
                         setTranscripts(prev => [...prev, {
                             text: data.text,
@@ -98,19 +102,8 @@ export function useDirectStream(url = 'ws://localhost:8000/ws') {
                         pcmData[i] = Math.max(-1, Math.min(1, inputData[i])) * 0x7FFF;
                     }
 
-                    // Send as base64 chunk
-                    // Note: In a production app, we'd send raw binary, but our current WS handles JSON
-                    const uint8 = new Uint8Array(pcmData.buffer);
-                    let binary = '';
-                    for (let i = 0; i < uint8.length; i++) {
-                        binary += String.fromCharCode(uint8[i]);
-                    }
-                    const base64data = btoa(binary);
-
-                    wsRef.current.send(JSON.stringify({
-                        type: 'audio',
-                        data: base64data
-                    }));
+                    // Send raw int16 PCM as a binary frame; text frames are reserved for control messages
+                    wsRef.current.send(pcmData.buffer);
                 }
             };
 
@@ -14,6 +14,9 @@ export const useLiveKit = (defaultUrl) => {
     const roomRef = useRef(null);
     const reconnectTimeoutRef = useRef(null);
     const reconnectAttemptsRef = useRef(0);
+    // Transcription seqs seen per sender connection; transcripts arrive over the unreliable
+    // channel, so a packet can be late or duplicated but every seq is a distinct utterance
+    const seenSeqRef = useRef({});
     const maxReconnectAttempts = 5;
 
     const connect = useCallback(async (token, url) => {
@@ -81,13 +84,40 @@ export const useLiveKit = (defaultUrl) => {
             const decoder = new TextDecoder();
             const str = decoder.decode(payload);
             try {
-                const data = JSON.parse(str);
-                if (data.type === 'transcription') {
-                    setTranscripts(prev => [...prev, {
+                const parsed = JSON.parse(str);
+                // The agent coalesces packets queued in the same tick into one array
+                const messages = Array.isArray(parsed) ? parsed : [parsed];
+                // seq restarts with each agent connection, which gets a new participant sid
+                const sender = participant?.sid ?? '';
+                const seen = (seenSeqRef.current[sender] ??= new Set());
+                const incoming = messages
+                    .filter(data => data.type === 'transcription')
+                    .filter(data => {
+                        if (data.seq === undefined) return true;
+                        if (seen.has(data.seq)) return false;
+                        seen.add(data.seq);
+                        return true;
+                    })
+                    .map(data => ({
                         text: data.text,
                         timestamp: Date.now(),
-                        latency: data.latency_ms
-                    }]);
+                        latency: data.latency_ms,
+                        sender,
+                        seq: data.seq
+                    }));
+                if (incoming.length) {
+                    setTranscripts(prev => {
+                        const next = [...prev];
+                        for (const entry of incoming) {
+                            // A late packet goes back in front of this sender's newer utterances
+                            let i = next.length;
+                            if (entry.seq !== undefined) {
+                                while (i > 0 && next[i - 1].sender === sender && next[i - 1].seq > entry.seq) i--;
+                            }
+                            next.splice(i, 0, entry);
+                        }
+                        return next;
+                    });
                 }
             } catch (e) {
                 console.error('Failed to parse data message', e);
@@ -0,0 +1,85 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("vox-nexus-kernels")
+
+try:
+    from numba import njit
+except ImportError:
+    logger.info("ℹ️ numba not installed. Using NumPy audio kernels.")
+    njit = None
+
+INT16_SCALE = np.float32(1.0 / 32768.0)
+
+
+def _pcm_to_float_and_peak_np(src_i16: np.ndarray, dst_f32: np.ndarray) -> int:
+    """NumPy fallback: one conversion pass plus max/min reductions, no temporaries."""
+    np.multiply(src_i16, INT16_SCALE, out=dst_f32, casting="unsafe")
+    if not src_i16.size:
+        return 0
+    # max(|x|) == max(max, -min); done in Python ints so -(-32768) cannot wrap
+    return max(int(src_i16.max()), -int(src_i16.min()))
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _pcm_to_float_and_peak_jit(src_i16, dst_f32):
+        # Branch-free max/min reductions let LLVM vectorize the loop together with the scale
+        hi = np.int32(0)
+        lo = np.int32(0)
+        for i in range(src_i16.size):
+            v = np.int32(src_i16[i])
+            hi = max(hi, v)
+            lo = min(lo, v)
+            dst_f32[i] = v * INT16_SCALE
+        return max(hi, -lo)
+
+
+def pcm_to_float_and_peak(src_i16: np.ndarray, dst_f32: np.ndarray) -> int:
+    """Scales int16 PCM into dst_f32 ([-1, 1]) and returns the absolute peak, in one pass."""
+    if njit is not None:
+        return int(_pcm_to_float_and_peak_jit(src_i16, dst_f32))
+    return _pcm_to_float_and_peak_np(src_i16, dst_f32)
+
+
+def _count_voiced_frames_np(src_i16: np.ndarray, frame_len: int, rms_threshold: float) -> int:
+    n_frames = src_i16.size // frame_len
+    frames = src_i16[:n_frames * frame_len].reshape(n_frames, frame_len)
+    # einsum casts through its internal buffer, so no float32 copy of the chunk is made
+    energies = np.einsum("ij,ij->i", frames, frames, dtype=np.float32)
+    return int(np.count_nonzero(energies >= rms_threshold * rms_threshold * frame_len))
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _count_voiced_frames_jit(src_i16, frame_len, rms_threshold):
+        # Compare sum of squares against threshold^2 * N so no sqrt is needed per frame
+        limit = rms_threshold * rms_threshold * frame_len
+        voiced = 0
+        for f in range(src_i16.size // frame_len):
+            energy = 0.0
+            for i in range(f * frame_len, (f + 1) * frame_len):
+                v = np.float32(src_i16[i])
+                energy += v * v
+            if energy >= limit:
+                voiced += 1
+        return voiced
+
+
+def count_voiced_frames(src_i16: np.ndarray, frame_len: int, rms_threshold: float) -> int:
+    """Counts frame_len-sample frames whose RMS reaches rms_threshold (energy VAD)."""
+    if frame_len <= 0:
+        return 0
+    if njit is not None:
+        return int(_count_voiced_frames_jit(src_i16, frame_len, float(rms_threshold)))
+    return _count_voiced_frames_np(src_i16, frame_len, rms_threshold)
+
+
+def warmup():
+    """Compiles the JIT kernels ahead of the first audio chunk."""
+    # numba specializes on writability too: np.frombuffer over bytes (direct-mode messages,
+    # LiveKit frames) is read-only and would otherwise compile on the first live call
+    for src in (np.zeros(160, dtype=np.int16), np.frombuffer(bytes(320), dtype=np.int16)):
+        pcm_to_float_and_peak(src, np.empty(src.size, dtype=np.float32))
+        count_voiced_frames(src, src.size, 1.0)
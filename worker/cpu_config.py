@@ -0,0 +1,34 @@
+import logging
+import os
+
+logger = logging.getLogger("vox-nexus-stt")
+
+
+def _positive_env(name: str, default: int) -> int:
+    """Reads a positive integer from the environment; unset, empty or <= 0 gives the default."""
+    raw = os.getenv(name)
+    if not raw:
+        return default
+    value = int(raw)
+    if value <= 0:
+        logger.warning(f"⚠️ {name}={value} must be positive, using {default}")
+        return default
+    return value
+
+
+def available_cpus() -> int:
+    """Logical CPUs this process may run on (the container's cpuset, not the whole host)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Each inference worker drives one CTranslate2 replica with its own block of CPUs.
+# WHISPER_WORKERS=1 with WHISPER_CPU_THREADS=<cpus> runs one inference at a time across all of them
+CPU_THREADS_PER_MODEL = _positive_env("WHISPER_CPU_THREADS", 4)
+INFERENCE_WORKERS = _positive_env("WHISPER_WORKERS", max(1, available_cpus() // CPU_THREADS_PER_MODEL))
+
+# OpenMP/BLAS pools are sized when numpy and ctranslate2 first load, so this module has to be
+# imported before either. Without a cap, numpy's mel matmul in every worker spins up a thread per CPU.
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, str(CPU_THREADS_PER_MODEL))
@@ -1,12 +1,16 @@
+# Caps the OpenMP/BLAS thread pools; must be imported before numpy
+import cpu_config  # noqa: F401
+
 import asyncio
 import base64
-import json
+import itertools
+from dataclasses import dataclass
 import logging
 import time
 import os
 import signal
-import threading
 import numpy as np
+import orjson
 import uvicorn
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
@@ -14,12 +18,47 @@ from livekit import rtc, api
 from dotenv import load_dotenv
 
 # Import our singleton STT service
-from stt_service import stt_service
+from stt_service import stt_service, stt_batcher
+from audio_kernels import count_voiced_frames, pcm_to_float_and_peak, warmup as warmup_kernels
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # --- Configuration ---
 SAMPLE_RATE = 16000
 BYTES_PER_SAMPLE = 2 
-BUFFER_SIZE_BYTES = int(SAMPLE_RATE * 3.0 * BYTES_PER_SAMPLE) # 3.0 second chunks for better VAD
+BUFFER_SIZE_BYTES = int(SAMPLE_RATE * 3.0 * BYTES_PER_SAMPLE) # Direct mode: longest chunk before a forced flush
+
+# Chunks end on a pause (energy VAD per frame in agent mode, per message in direct mode)
+# instead of a fixed window, so words are not cut in half and silence does not trigger
+# extra encoder passes
+MIN_CHUNK_SAMPLES = int(SAMPLE_RATE * 1.0)
+MAX_CHUNK_SAMPLES = int(SAMPLE_RATE * 20.0)
+END_OF_SPEECH_MS = 100
+SPEECH_PEAK_THRESHOLD = 800
+
+# Energy VAD: a frame counts as speech when its RMS reaches the threshold. Direct mode splits
+# each message into 20 ms VAD_FRAME_SAMPLES frames; agent mode classifies each LiveKit frame
+# (10 ms) whole, since it is already shorter than one VAD frame.
+# Chunks with less than MIN_SPEECH_MS of speech (claps, key presses) never reach Whisper.
+VAD_FRAME_SAMPLES = SAMPLE_RATE // 50
+SPEECH_RMS_THRESHOLD = 300
+MIN_SPEECH_MS = 200
+
+# Packets waiting for publish_outbox; if publishing stalls, the oldest are dropped first
+MAX_OUTBOX_PACKETS = 256
+# Lossy packets are not fragmented-and-retried; keep each payload inside one ~1.3 KB MTU
+MAX_LOSSY_PAYLOAD_BYTES = 1200
+
+# set_language and friends are tiny; anything bigger on the data channel is not a control message
+MAX_CONTROL_PACKET_BYTES = 512
+
+# Pre-encoded transcription packet; string fields are filled with orjson.dumps() output so they stay escaped
+# seq increases per agent connection so the client can order late packets and drop duplicates
+TRANSCRIPTION_TEMPLATE = b'{"type":"transcription","text":%s,"participant":"agent","language":%s,"latency_ms":%d,"seq":%d}'
+DIRECT_TRANSCRIPTION_TEMPLATE = b'{"type":"transcription","text":%s,"isFinal":true,"latency_ms":%d}'
 
 # --- Setup ---
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
@@ -29,11 +68,27 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: [%(na
 logger = logging.getLogger("SYSTEM")
 agent_logger = logging.getLogger("AGENT-MODE")
 direct_logger = logging.getLogger("DIRECT-MODE")
+# faster-whisper logs every chunk it processes at INFO
+logging.getLogger("faster_whisper").setLevel(logging.WARNING)
 
 # --- Shared State ---
 # Since we are now in a SINGLE process with threads, we can share state if needed.
 # However, STT Service is already a singleton module.
 
+@dataclass(slots=True)
+class LanguageState:
+    """Language a participant is transcribed in; set_language updates it in place, so
+    the participant's transcribe_track task reads the new code on its next chunk.
+    Until a participant sets their own code, they follow the fallback (the room default)."""
+    code: str | None = None
+    fallback: "LanguageState | None" = None
+
+    @property
+    def current(self) -> str:
+        if self.code is not None:
+            return self.code
+        return self.fallback.current if self.fallback is not None else "en"
+
 # --- 🔌 Direct Mode Logic (FastAPI Server) ---
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
@@ -46,116 +101,201 @@ async def health_check():
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     direct_logger.info("🔌 Client connected")
-    audio_buffer = bytearray()
+    # Preallocated byte buffer; messages are written through a memoryview and the int16
+    # array is materialized once per chunk
+    audio_buffer = bytearray(BUFFER_SIZE_BYTES * 2)
+    audio_view = memoryview(audio_buffer)
+    buffered = 0
+    speech_ms = silence_ms = 0
+    # float32 conversion target reused across chunks; sized like audio_buffer, since a forced
+    # flush lands a client frame past BUFFER_SIZE_BYTES (grown if a chunk is ever longer)
+    float_scratch = np.empty(len(audio_buffer) // BYTES_PER_SAMPLE, dtype=np.float32)
     current_language = "en"
     
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             
-            if message.get('type') == 'set_language':
-                current_language = message.get('code', 'en')
-                direct_logger.info(f"🌐 Language set to '{current_language}'")
-                continue
-
-            if message.get('type') == 'audio':
-                chunk = base64.b64decode(message['data'])
-                audio_buffer.extend(chunk)
+            # Audio arrives as binary frames of raw int16 LE PCM; text frames carry JSON control messages
+            chunk = message.get("bytes")
+            if chunk is None:
+                control = orjson.loads(message["text"])
+                msg_type = control.get('type')
                 
-                if len(audio_buffer) >= BUFFER_SIZE_BYTES:
-                    start_time = time.time()
-                    # Process chunks of exactly buffer size
-                    even_length = (len(audio_buffer) // 2) * 2
-                    current_segment = audio_buffer[:even_length]
-                    remainder = audio_buffer[even_length:]
-                    
-                    full_arr_view = np.frombuffer(current_segment, dtype=np.int16)
-                    peak_vol = np.abs(full_arr_view).max() if len(full_arr_view) > 0 else 0
+                if msg_type == 'set_language':
+                    current_language = control.get('code', 'en')
+                    direct_logger.info(f"🌐 Language set to '{current_language}'")
+                    continue
+                if msg_type != 'audio':
+                    continue
+                # Older clients still send base64 audio inside JSON
+                chunk = base64.b64decode(control['data'])
+            
+            if buffered + len(chunk) > len(audio_buffer):
+                grown = bytearray(buffered + len(chunk))
+                grown[:buffered] = audio_view[:buffered]
+                audio_buffer, audio_view = grown, memoryview(grown)
+            audio_view[buffered:buffered + len(chunk)] = chunk
+            buffered += len(chunk)
+            
+            # Energy VAD per message, so a chunk can end on the first pause after a second of audio
+            samples = np.frombuffer(chunk, dtype=np.int16, count=len(chunk) // BYTES_PER_SAMPLE)
+            voiced = count_voiced_frames(samples, VAD_FRAME_SAMPLES, SPEECH_RMS_THRESHOLD)
+            if voiced:
+                speech_ms += voiced * 20
+                silence_ms = 0
+            else:
+                silence_ms += samples.size * 1000 // SAMPLE_RATE
+            
+            end_of_speech = buffered >= MIN_CHUNK_SAMPLES * BYTES_PER_SAMPLE and silence_ms >= END_OF_SPEECH_MS
+            if end_of_speech or buffered >= BUFFER_SIZE_BYTES:
+                start_time = time.time()
+                # Whole samples only; an odd trailing byte waits for the next message
+                n_samples = buffered // BYTES_PER_SAMPLE
+                full_arr_view = np.frombuffer(audio_buffer, dtype=np.int16, count=n_samples)
+                
+                float_arr = None
+                if speech_ms >= MIN_SPEECH_MS:
+                    if float_scratch.size < n_samples:
+                        float_scratch = np.empty(n_samples, dtype=np.float32)
+                    float_arr = float_scratch[:n_samples]
+                    peak_vol = pcm_to_float_and_peak(full_arr_view, float_arr)
                     
                     # Silence Gate
-                    if peak_vol < 500: 
-                        audio_buffer = remainder
-                        continue
-                    
-                    audio_buffer = remainder
-                    float_arr = full_arr_view.astype(np.float32) / 32768.0
-                    
-                    # Run STT in the main Executor (Thread Pool available to FastAPI)
-                    loop = asyncio.get_running_loop()
-                    text = await loop.run_in_executor(None, lambda: stt_service.transcribe(float_arr, language=current_language))
-                    inference_duration = time.time() - start_time
-                    
-                    if text:
-                        direct_logger.info(f"📝 '{text}' (TAT: {inference_duration:.3f}s)")
-                        await websocket.send_json({
-                            "type": "transcription",
-                            "text": text,
-                            "isFinal": True,
-                            "latency_ms": int(inference_duration * 1000)
-                        })
+                    if peak_vol < 500:
+                        float_arr = None
+                
+                remainder = buffered - n_samples * BYTES_PER_SAMPLE
+                audio_view[:remainder] = audio_view[buffered - remainder:buffered]
+                buffered = remainder
+                speech_ms = silence_ms = 0
+                if float_arr is None:
+                    continue
+                
+                # Pooled with chunks from other connections and tracks into one Whisper batch
+                text = await stt_batcher.submit(float_arr, current_language)
+                inference_duration = time.time() - start_time
+                
+                if text:
+                    if direct_logger.isEnabledFor(logging.DEBUG):
+                        direct_logger.debug(f"📝 '{text}' (TAT: {inference_duration:.3f}s)")
+                    payload = DIRECT_TRANSCRIPTION_TEMPLATE % (orjson.dumps(text), int(inference_duration * 1000))
+                    await websocket.send_bytes(payload)
     except WebSocketDisconnect:
         direct_logger.info("🔌 Client disconnected")
     except Exception as e:
         direct_logger.error(f"❌ Message error: {e}")
 
-def run_fastapi_thread():
-    """Starts the FastAPI server in a separate thread."""
+async def serve_direct_mode():
+    """Runs the FastAPI server on the current event loop."""
     direct_logger.info("🚀 Starting Direct Mode (WebSocket) server on port 8000...")
-    # uvicorn.run is blocking, so we run it in this thread
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="warning")
+    config = uvicorn.Config(app, host="0.0.0.0", port=8000, log_level="warning")
+    await uvicorn.Server(config).serve()
 
 
 # --- 🛰️ LiveKit Agent Mode (Async Loop) ---
 
-async def transcribe_track(track: rtc.RemoteAudioTrack, participant: rtc.RemoteParticipant, room: rtc.Room, state: dict):
+def enqueue_packet(outbox: asyncio.Queue, packet: bytes):
+    """Queues a packet for publish_outbox; when the outbox is full the oldest packet is dropped."""
+    if outbox.full():
+        outbox.get_nowait()
+    outbox.put_nowait(packet)
+
+def coalesce_packets(packets: list[bytes], max_bytes: int) -> list[bytes]:
+    """Joins packets into JSON arrays, starting a new array before one would exceed max_bytes.
+    A packet that is already over the limit goes out on its own."""
+    payloads, group, size = [], [], 1
+    for packet in packets:
+        if group and size + 1 + len(packet) > max_bytes:
+            payloads.append(group)
+            group, size = [], 1
+        group.append(packet)
+        size += 1 + len(packet)
+    if group:
+        payloads.append(group)
+    return [g[0] if len(g) == 1 else b"[" + b",".join(g) + b"]" for g in payloads]
+
+async def publish_outbox(room: rtc.Room, outbox: asyncio.Queue):
+    """Sends queued packets on the lossy channel; packets queued in the same tick go out as
+    JSON arrays split to stay under one MTU."""
+    while True:
+        batch = [await outbox.get()]
+        while not outbox.empty():
+            batch.append(outbox.get_nowait())
+        
+        for payload in coalesce_packets(batch, MAX_LOSSY_PAYLOAD_BYTES):
+            try:
+                await room.local_participant.publish_data(payload, reliable=False)
+            except Exception as e:
+                agent_logger.error(f"❌ Publish error: {e}")
+
+async def transcribe_track(track: rtc.RemoteAudioTrack, participant: rtc.RemoteParticipant, room: rtc.Room, language: LanguageState, outbox: asyncio.Queue, seq: itertools.count):
     """Processes a single remote audio track."""
     identity = participant.identity
     agent_logger.info(f"🎤 Starting for {identity} (track {track.sid})")
     
-    audio_buffer = bytearray()
+    # Preallocated PCM window; frames are copied straight in, no per-frame bytes objects
+    pcm_buf = np.empty(MAX_CHUNK_SAMPLES, dtype=np.int16)
+    float_buf = np.empty(MAX_CHUNK_SAMPLES, dtype=np.float32)
+    write_idx = 0
+    silence_ms = 0.0
+    speech_ms = 0.0
     
-    async for audio_frame in rtc.AudioStream(track):
+    async for audio_frame in rtc.AudioStream(track, sample_rate=SAMPLE_RATE, num_channels=1):
         # Stop immediately if room is disconnected
         if room.connection_state != rtc.ConnectionState.CONN_CONNECTED:
             break
             
-        audio_buffer.extend(audio_frame.frame.data.tobytes())
+        src = np.frombuffer(audio_frame.frame.data, dtype=np.int16)
+        n = min(src.size, MAX_CHUNK_SAMPLES - write_idx)
+        pcm_buf[write_idx:write_idx + n] = src[:n]
+        write_idx += n
+        
+        # Track speech and trailing silence so the chunk is flushed on a pause
+        frame_ms = src.size * 1000 / SAMPLE_RATE
+        if count_voiced_frames(src, src.size, SPEECH_RMS_THRESHOLD):
+            speech_ms += frame_ms
+            silence_ms = 0.0
+        else:
+            silence_ms += frame_ms
 
-        if len(audio_buffer) >= BUFFER_SIZE_BYTES:
+        end_of_phrase = write_idx >= MIN_CHUNK_SAMPLES and silence_ms >= END_OF_SPEECH_MS
+        if end_of_phrase or write_idx >= MAX_CHUNK_SAMPLES:
              start_time = time.time()
-             even_length = (len(audio_buffer) // 2) * 2
-             current_segment = audio_buffer[:even_length]
-             remainder = audio_buffer[even_length:]
+             chunk_samples, chunk_speech_ms = write_idx, speech_ms
+             speech_ms = 0.0
+             
+             # Skip mostly-silent chunks before converting them at all
+             if chunk_speech_ms >= MIN_SPEECH_MS:
+                 float_arr = float_buf[:chunk_samples]
+                 peak_vol = pcm_to_float_and_peak(pcm_buf[:chunk_samples], float_arr)
+             else:
+                 peak_vol = 0
              
-             full_arr_view = np.frombuffer(current_segment, dtype=np.int16)
-             peak_vol = np.abs(full_arr_view).max() if len(full_arr_view) > 0 else 0
+             # Carry the tail of the frame that overflowed the window into the next one
+             write_idx = src.size - n
+             pcm_buf[:write_idx] = src[n:]
              
              # Skip processing if audio is too quiet (mic muted or silence)
-             if peak_vol < 800:  # Increased threshold - only process actual speech
-                 audio_buffer = remainder
+             if peak_vol < SPEECH_PEAK_THRESHOLD:  # Only process actual speech
                  continue
              
-             float_arr = full_arr_view.astype(np.float32) / 32768.0
-             audio_buffer = remainder
-             
              try:
-                 lang = state.get(identity, state.get("default", "en"))
+                 lang = language.current
                  
-                 # Access the SAME stt_service instance (Thread-safe enough for inference)
-                 loop = asyncio.get_running_loop()
-                 text = await loop.run_in_executor(None, lambda: stt_service.transcribe(float_arr, language=lang))
+                 # Pooled with chunks from the other tracks into one Whisper batch
+                 text = await stt_batcher.submit(float_arr, lang)
                  inference_duration = time.time() - start_time
                  
                  if text:
-                     agent_logger.info(f"📝 '{text}' (TAT: {inference_duration:.3f}s)")
-                     payload = json.dumps({
-                         "type": "transcription", 
-                         "text": text, 
-                         "participant": "agent", 
-                         "latency_ms": int(inference_duration * 1000)
-                     })
-                     await room.local_participant.publish_data(payload.encode('utf-8'), reliable=True)
+                     if agent_logger.isEnabledFor(logging.DEBUG):
+                         agent_logger.debug(f"📝 '{text}' (TAT: {inference_duration:.3f}s)")
+                     payload = TRANSCRIPTION_TEMPLATE % (orjson.dumps(text), orjson.dumps(lang), int(inference_duration * 1000), next(seq))
+                     # Unreliable: a transcript that misses its moment is stale, and it must not
+                     # head-of-line-block the ones behind it
+                     enqueue_packet(outbox, payload)
              except Exception as e:
                  agent_logger.error(f"❌ Transcription error: {e}")
 
@@ -173,7 +313,14 @@ async def run_agent_main_loop():
 
     # Using the correct API Client
     lk_api_client = api.LiveKitAPI(url, api_key, api_secret)
-    session_state = {"default": "en"}
+    # "default" applies to participants that have not sent set_language yet
+    session_state: dict[str, LanguageState] = {"default": LanguageState("en")}
+
+    def language_for(identity: str) -> LanguageState:
+        state = session_state.get(identity)
+        if state is None:
+            state = session_state[identity] = LanguageState(fallback=session_state["default"])
+        return state
 
     agent_logger.info("💤 DORMANT. Polling for humans...")
 
@@ -205,75 +352,98 @@ async def run_agent_main_loop():
                 .to_jwt()
             
             room = rtc.Room()
+            outbox: asyncio.Queue = asyncio.Queue(maxsize=MAX_OUTBOX_PACKETS)
+            seq = itertools.count()
+            # Publications already being transcribed; a track present at connect time is
+            # reported both by track_subscribed and by the existing-track scan below
+            active_sids: set[str] = set()
+            
+            def start_transcription(track: rtc.Track, publication: rtc.TrackPublication, participant: rtc.RemoteParticipant):
+                sid = publication.sid
+                if sid in active_sids:
+                    return
+                active_sids.add(sid)
+                agent_logger.info(f"🎤 Catching audio from {participant.identity}")
+                task = asyncio.create_task(transcribe_track(track, participant, room, language_for(participant.identity), outbox, seq))
+                task.add_done_callback(lambda _: active_sids.discard(sid))
             
             @room.on("track_subscribed")
             def on_track_subscribed(track: rtc.Track, publication: rtc.TrackPublication, participant: rtc.RemoteParticipant):
                 if track.kind == rtc.TrackKind.KIND_AUDIO:
-                    agent_logger.info(f"🎤 Catching audio from {participant.identity}")
-                    asyncio.create_task(transcribe_track(track, participant, room, session_state))
+                    start_transcription(track, publication, participant)
 
             @room.on("data_received")
             def on_data_received(data_packet: rtc.DataPacket):
+                # Never let an oversized packet stall the loop the audio tasks run on;
+                # control messages are JSON objects, so anything else is skipped unparsed
+                data = data_packet.data
+                if len(data) > MAX_CONTROL_PACKET_BYTES or data[:1] != b"{":
+                    return
                 try:
-                    payload = json.loads(data_packet.data.decode('utf-8'))
+                    payload = orjson.loads(data)
                     if payload.get('type') == 'set_language':
                         identity = data_packet.participant.identity if data_packet.participant else "default"
                         lang = payload.get('code', 'en')
-                        session_state[identity] = lang
+                        language_for(identity).code = lang
                         agent_logger.info(f"🌐 Language set to '{lang}' for {identity}")
                 except Exception:
                     pass
 
             await room.connect(url, token)
             agent_logger.info("✅ Connected and Listening.")
+            sender = asyncio.create_task(publish_outbox(room, outbox))
             
             # Catch existing tracks
             for participant in room.remote_participants.values():
                  for publication in participant.track_publications.values():
                     if publication.track and publication.track.kind == rtc.TrackKind.KIND_AUDIO:
-                        asyncio.create_task(transcribe_track(publication.track, participant, room, session_state))
+                        start_transcription(publication.track, publication, participant)
             
             # Stay connected as long as humans are there
-            while room.connection_state == rtc.ConnectionState.CONN_CONNECTED:
-                await asyncio.sleep(5)
-                humans = [p for p in room.remote_participants.values() if not p.identity.startswith("agent-")]
-                if not humans:
-                    agent_logger.info("👋 Room Empty. Returning to DORMANT state.")
-                    await room.disconnect()
-                    break
+            try:
+                while room.connection_state == rtc.ConnectionState.CONN_CONNECTED:
+                    await asyncio.sleep(5)
+                    humans = [p for p in room.remote_participants.values() if not p.identity.startswith("agent-")]
+                    if not humans:
+                        agent_logger.info("👋 Room Empty. Returning to DORMANT state.")
+                        await room.disconnect()
+                        break
+            finally:
+                sender.cancel()
                 
         except Exception as e:
             agent_logger.error(f"❌ Agent Loop Error: {e}")
             await asyncio.sleep(5)
 
 
+async def run_engine(agent_enabled: bool):
+    """Runs the WebSocket server and the LiveKit agent side by side on one event loop."""
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(serve_direct_mode())
+        if agent_enabled:
+            tg.create_task(run_agent_main_loop())
+        else:
+            logger.info("🚫 Agent Mode Disabled. Serving WebSocket only...")
+
+
 # --- 🏛️ Main Entry Point ---
 
 if __name__ == "__main__":
-    logger.info("💎 VoxNexus Engine Starting (Single Process / Multi-Threaded)...")
+    logger.info("💎 VoxNexus Engine Starting (Single Process / Single Event Loop)...")
     
     # 1. Load Whisper Once (Global Memory)
     logger.info("🧠 Loading Whisper Model (Shared Memory)...")
     stt_service.load_model()
     logger.info("✅ Whisper Model Ready.")
+    warmup_kernels()
+    stt_batcher.start()
 
-    # 2. Start FastAPI in a background Thread
-    # Daemon thread ensures it dies when main thread exits
-    t_fastapi = threading.Thread(target=run_fastapi_thread, daemon=True)
-    t_fastapi.start()
-    
-    # 3. Start Agent Loop in Main Thread (Asyncio)
+    # 2. Serve WebSocket and run the agent on the main thread's loop
     disable_agent = os.getenv("DISABLE_AGENT_BOT", "false").lower() == "true"
-    
-    if not disable_agent:
-        try:
-            asyncio.run(run_agent_main_loop())
-        except KeyboardInterrupt:
-            logger.info("👋 Shutting down...")
-    else:
-        logger.info("🚫 Agent Mode Disabled. Keeping main thread alive for WebSocket...")
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("👋 Shutting down...")
+    # libuv-based loop when available: cheaper dispatch for the per-frame audio and WebSocket events
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
+    try:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(run_engine(not disable_agent))
+    except KeyboardInterrupt:
+        logger.info("👋 Shutting down...")
@@ -1,14 +1,30 @@
+import asyncio
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import queue
+import re
 import time
 import threading
-from typing import Optional, Set
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+# --- Threading ---
+# Sets the OpenMP/BLAS caps, so it comes before numpy
+from cpu_config import CPU_THREADS_PER_MODEL, INFERENCE_WORKERS
+
+import numpy as np
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger("vox-nexus-stt")
 
+STT_EXECUTOR = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="whisper")
+
 try:
+    import ctranslate2
     from faster_whisper import WhisperModel
+    from faster_whisper.tokenizer import Tokenizer
+    from faster_whisper.transcribe import get_ctranslate2_storage, get_suppressed_tokens
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
 except ImportError:
     logger.error("❌ faster_whisper not installed. STT will not work.")
     WhisperModel = None
@@ -21,69 +37,317 @@ HALLUCINATIONS: Set[str] = {
     "Music", "Violin music", "Eerie music", "Dramatic music",
     "Watching", "Sous-titres"
 }
+# Lowercased once: short artifacts must match exactly, longer ones anywhere in the text
+_SHORT_HALLUCINATIONS: frozenset = frozenset(h.casefold() for h in HALLUCINATIONS if len(h) < 10)
+# Long tier as one alternation, so a transcript is scanned once instead of once per phrase
+_LONG_HALLUCINATIONS: re.Pattern = re.compile(
+    "|".join(re.escape(h.casefold()) for h in sorted(HALLUCINATIONS) if len(h) >= 10)
+)
+
+INITIAL_PROMPT = "Use simple English."
+# Decode budget per second of audio; generous for token-dense scripts, but keeps a
+# repetition loop from running to the model's 448-token limit on a short chunk
+MAX_TOKENS_PER_SECOND = 20
+MIN_NEW_TOKENS = 32
+# Same "no speech" rule faster-whisper applies in transcribe()
+NO_SPEECH_THRESHOLD = 0.6
+LOG_PROB_THRESHOLD = -1.0
+# Multilingual checkpoint: a size name or a path to a pre-converted CTranslate2 model
+# (MODEL_SIZE is what docker-compose and the README set; WHISPER_MODEL is the older name)
+MODEL_NAME = os.getenv("MODEL_SIZE") or os.getenv("WHISPER_MODEL") or "small"
+# English-only distilled checkpoint for language == "en" (empty disables it)
+ENGLISH_MODEL = os.getenv("WHISPER_EN_MODEL", "distil-small.en")
+# Silero VAD settings for the pre-filter in transcribe_batch()
+VAD_PARAMETERS = dict(
+    min_silence_duration_ms=1000,  # Increased from 500ms
+    min_speech_duration_ms=150,  # Drop clicks/taps shorter than a syllable
+    threshold=0.3  # Lowered from default 0.5
+)
+# "cpu" or "cuda"; unset or empty means cpu
+DEVICE = os.getenv("WHISPER_DEVICE") or "cpu"
+# int8 weights with bf16/fp16 activations where the hardware supports them
+# (AVX-512 BF16 / VNNI on CPU, tensor cores on Ampere+ GPUs)
+COMPUTE_TYPE_PREFERENCE: Dict[str, Tuple[str, ...]] = {
+    "cpu": ("int8_bfloat16", "int8_float16", "int8"),
+    "cuda": ("int8_float16", "float16", "int8"),
+}
+
+
+def select_device() -> str:
+    """Returns WHISPER_DEVICE if CTranslate2 can use it here, else "cpu"."""
+    if DEVICE not in COMPUTE_TYPE_PREFERENCE:
+        logger.warning(f"⚠️ Unknown device '{DEVICE}' (expected {', '.join(COMPUTE_TYPE_PREFERENCE)}), falling back to cpu")
+        return "cpu"
+    if DEVICE == "cuda" and ctranslate2.get_cuda_device_count() == 0:
+        logger.warning("⚠️ No CUDA device visible, falling back to cpu")
+        return "cpu"
+    return DEVICE
+
+def select_compute_type(device: str = "cpu") -> str:
+    """Picks WHISPER_COMPUTE if set, else the fastest int8 variant CTranslate2 supports here."""
+    supported = ctranslate2.get_supported_compute_types(device)
+    requested = os.getenv("WHISPER_COMPUTE")
+    if requested:
+        if requested in supported:
+            return requested
+        logger.warning(f"⚠️ Compute type '{requested}' not supported on {device} ({', '.join(sorted(supported))}), falling back")
+    return next((c for c in COMPUTE_TYPE_PREFERENCE.get(device, ("int8",)) if c in supported), "int8")
+
+class _Decoder(NamedTuple):
+    """Everything generate() needs for one language, built once and reused for every chunk."""
+    model: 'WhisperModel'
+    tokenizer: 'Tokenizer'
+    prompt: List[int]
+    suppress_tokens: List[int]
 
 class WhisperService:
     def __init__(self):
         self.model: Optional['WhisperModel'] = None
-        self._lock = threading.Lock()
+        self.device = DEVICE
+        # Distilled English-only checkpoint: half the decoder layers, used when language == "en"
+        self.english_model: Optional['WhisperModel'] = None
+        self._decoders: Dict[str, _Decoder] = {}
+        self._vad_options: Optional['VadOptions'] = None
+        # Padded log-mel batch reused across calls; one per inference thread
+        self._scratch = threading.local()
+    
+    def _create_model(self, name: str, compute_type: str) -> 'WhisperModel':
+        return WhisperModel(
+            name,
+            device=self.device,
+            compute_type=compute_type,
+            cpu_threads=CPU_THREADS_PER_MODEL,
+            num_workers=INFERENCE_WORKERS,
+            download_root=None
+        )
     
     def load_model(self):
         """Loads the Whisper model if not already loaded."""
         if not self.model and WhisperModel:
             try:
-                logger.info("🧠 Loading Whisper Model (small)...")
-                self.model = WhisperModel("small", device="cpu", compute_type="int8", download_root=None)
-                logger.info("✅ Whisper Model (small) Loaded Successfully!")
+                self.device = select_device()
+                compute_type = select_compute_type(self.device)
+                logger.info(f"🧠 Loading Whisper Model ({MODEL_NAME}, {self.device}, {compute_type})...")
+                self.model = self._create_model(MODEL_NAME, compute_type)
+                self._vad_options = VadOptions(**VAD_PARAMETERS)
+                logger.info(f"✅ Whisper Model ({MODEL_NAME}) Loaded Successfully!")
             except Exception as e:
                 logger.error(f"❌ Failed to load Whisper Model: {e}")
+                return
+            
+            if ENGLISH_MODEL:
+                try:
+                    logger.info(f"🧠 Loading English Model ({ENGLISH_MODEL})...")
+                    self.english_model = self._create_model(ENGLISH_MODEL, compute_type)
+                    logger.info(f"✅ English Model ({ENGLISH_MODEL}) Loaded Successfully!")
+                except Exception as e:
+                    logger.warning(f"⚠️ English Model unavailable, using {MODEL_NAME} for English: {e}")
+            
+            # Silero's ONNX session is created on first use; build it now rather than on the first chunk
+            try:
+                get_speech_timestamps(np.zeros(16000, dtype=np.float32), self._vad_options)
+            except Exception as e:
+                logger.warning(f"⚠️ VAD warmup failed: {e}")
         elif self.model:
             logger.info("🧠 Model already loaded (cached).")
+    
+    def _model_for(self, language: str) -> 'WhisperModel':
+        return self.english_model if language == "en" and self.english_model else self.model
 
     def filter_hallucinations(self, text: str) -> str:
         """Filters out common Whisper hallucinations."""
-        if not text: return ""
-        cleaned = text.strip()
+        cleaned = text.strip() if text else ""
         if not cleaned: return ""
-        cleaned_lower = cleaned.lower()
+        cleaned_lower = cleaned.casefold()
         
-        for h in HALLUCINATIONS:
-            h_low = h.lower()
-            # Exact match for short artifacts to avoid blocking valid sentences
-            if len(h_low) < 10:
-                if cleaned_lower == h_low: return ""
-            # Partial match for longer artifact strings
-            elif h_low in cleaned_lower:
-                return ""
+        # Exact match for short artifacts to avoid blocking valid sentences
+        if cleaned_lower in _SHORT_HALLUCINATIONS:
+            return ""
+        # Partial match for longer artifact strings
+        if _LONG_HALLUCINATIONS.search(cleaned_lower):
+            return ""
         
         # Catch "Thank you" variants specifically
-        if "thank you" in cleaned_lower and len(cleaned_lower) < 20:
+        if len(cleaned_lower) < 20 and "thank you" in cleaned_lower:
             return ""
             
         return cleaned
 
-    def transcribe(self, float_arr, language="en", vad_threshold=0.6):
+    def _decoder_for(self, language: str) -> _Decoder:
+        """Returns the cached model, tokenizer, prompt and suppressed tokens for a language."""
+        decoder = self._decoders.get(language)
+        if decoder is None:
+            model = self._model_for(language)
+            tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language)
+            # <|startofprev|> prompt <|startoftranscript|><|lang|><|transcribe|><|notimestamps|>
+            # Leading space as faster-whisper adds it to initial_prompt, so the tokens match transcribe()
+            prompt_tokens = tokenizer.encode(" " + INITIAL_PROMPT.strip())
+            prompt = model.get_prompt(tokenizer, previous_tokens=prompt_tokens, without_timestamps=True)
+            decoder = self._decoders[language] = _Decoder(model, tokenizer, prompt, get_suppressed_tokens(tokenizer, [-1]))
+        return decoder
+
+    def _speech_span(self, float_arr: np.ndarray) -> Optional[np.ndarray]:
+        """Trims a chunk to its first..last Silero speech sample; None if it holds no speech."""
+        speech = get_speech_timestamps(float_arr, self._vad_options)
+        if not speech:
+            return None
+        return float_arr[speech[0]["start"]:speech[-1]["end"]]
+
+    def _features_for(self, model: 'WhisperModel', float_arrs: List[np.ndarray]) -> np.ndarray:
+        """Writes each chunk's log-mel into a reusable [batch, n_mels, 3000] buffer, zero-padded like pad_or_trim."""
+        n_mels = model.model.n_mels
+        n_frames = model.feature_extractor.nb_max_frames
+        features = getattr(self._scratch, "features", None)
+        if features is None or features.shape[0] < len(float_arrs) or features.shape[1] != n_mels:
+            features = np.empty((len(float_arrs), n_mels, n_frames), dtype=np.float32)
+            self._scratch.features = features
+        
+        features = features[:len(float_arrs)]
+        for i, float_arr in enumerate(float_arrs):
+            mel = model.feature_extractor(float_arr)[:, :-1][:, :n_frames]
+            features[i, :, :mel.shape[1]] = mel
+            features[i, :, mel.shape[1]:] = 0.0
+        return features
+
+    def _generate(self, model: 'WhisperModel', float_arrs: List[np.ndarray], decoders: List[_Decoder]) -> List[str]:
+        features = self._features_for(model, float_arrs)
+        prompts = [decoder.prompt for decoder in decoders]
+        longest_s = max(len(float_arr) for float_arr in float_arrs) / model.feature_extractor.sampling_rate
+        new_tokens = max(MIN_NEW_TOKENS, int(longest_s * MAX_TOKENS_PER_SECOND))
+        max_length = min(model.max_length, max(len(prompt) for prompt in prompts) + new_tokens)
+        
+        # No lock: CTranslate2 dispatches concurrent calls to its num_workers model replicas
+        results = model.model.generate(
+            get_ctranslate2_storage(features),
+            prompts,
+            beam_size=1,
+            max_length=max_length,
+            suppress_blank=True,
+            suppress_tokens=decoders[0].suppress_tokens,
+            return_scores=True,
+            return_no_speech_prob=True,
+        )
+        
+        texts = []
+        for decoder, result in zip(decoders, results):
+            tokens = result.sequences_ids[0]
+            avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+            if result.no_speech_prob > NO_SPEECH_THRESHOLD and avg_logprob < LOG_PROB_THRESHOLD:
+                texts.append("")
+                continue
+            texts.append(self.filter_hallucinations(decoder.tokenizer.decode(tokens)))
+        return texts
+
+    def transcribe_batch(self, float_arrs: List[np.ndarray], languages: List[str]) -> List[str]:
+        """Transcribes several independent chunks with one encoder/decoder call per model."""
+        texts = [""] * len(float_arrs)
         if not self.model:
-            return ""
+            return texts
         
+        decoders: List[Optional[_Decoder]] = []
+        for language in languages:
+            try:
+                decoders.append(self._decoder_for(language))
+            except ValueError as e:
+                logger.error(f"❌ Unsupported language '{language}': {e}")
+                decoders.append(None)
+        
+        # Silero VAD before batching: chunks without speech never reach the encoder,
+        # the rest go in trimmed to their speech span
+        chunks = list(float_arrs)
+        for i, decoder in enumerate(decoders):
+            if decoder is None:
+                continue
+            try:
+                span = self._speech_span(chunks[i])
+            except Exception as e:
+                # Transcribe it untrimmed rather than lose it or stall the batch
+                logger.error(f"❌ VAD error, transcribing chunk untrimmed: {e}")
+                continue
+            if span is None:
+                decoders[i] = None
+            else:
+                chunks[i] = span
+        
+        # English chunks run on the distilled model, everything else on the multilingual one
+        models = {id(d.model): d.model for d in decoders if d is not None}
+        for model in models.values():
+            indices = [i for i, d in enumerate(decoders) if d is not None and d.model is model]
+            try:
+                group_texts = self._generate(model, [chunks[i] for i in indices], [decoders[i] for i in indices])
+            except Exception as e:
+                logger.error(f"❌ Batch transcription error: {e}")
+                continue
+            for i, text in zip(indices, group_texts):
+                texts[i] = text
+        return texts
+
+
+class TranscriptionBatcher:
+    """Pools chunks from concurrent streams into a single Whisper batch.
+    
+    Runs on its own thread so callers on any event loop (LiveKit agent, FastAPI) can share it.
+    Batches execute on STT_EXECUTOR; while every worker is busy, new chunks keep queueing
+    and go out together in the next batch.
+    """
+    
+    def __init__(self, service: WhisperService, max_batch: int = 8, max_wait: float = 0.05):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._slots = threading.BoundedSemaphore(INFERENCE_WORKERS)
+    
+    def start(self):
+        """Starts the batching thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stt-batcher", daemon=True)
+            self._thread.start()
+    
+    async def submit(self, float_arr: np.ndarray, language: str = "en") -> str:
+        """Queues a chunk and waits for its transcription."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((float_arr, language, future))
+        return await asyncio.wrap_future(future)
+    
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            # Drop submissions whose caller was cancelled while waiting
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                self._slots.release()
+                continue
+            
+            STT_EXECUTOR.submit(self._run_batch, batch)
+    
+    def _run_batch(self, batch):
+        float_arrs, languages, futures = zip(*batch)
         try:
-            with self._lock:
-                segments, _ = self.model.transcribe(
-                    float_arr, 
-                    beam_size=3, 
-                    language=language, 
-                    condition_on_previous_text=False,
-                    vad_filter=True, 
-                    vad_parameters=dict(
-                        min_silence_duration_ms=1000,  # Increased from 500ms
-                        threshold=0.3  # Lowered from default 0.5
-                    ),
-                    initial_prompt="Use simple English."
-                )
-            text = " ".join([segment.text for segment in segments]).strip()
-            return self.filter_hallucinations(text)
-        except Exception as e:
-            logger.error(f"❌ Transcription error: {e}")
-            return ""
+            texts = self.service.transcribe_batch(list(float_arrs), list(languages))
+            for future, text in zip(futures, texts):
+                future.set_result(text)
+        except BaseException as e:
+            logger.error(f"❌ Batch transcription failed: {e}")
+            # Resolve every caller, otherwise its track awaits this batch forever
+            for future in futures:
+                if not future.done():
+                    future.set_result("")
+        finally:
+            self._slots.release()
 
-# Singleton instance
+# Singleton instances
 stt_service = WhisperService()
+stt_batcher = TranscriptionBatcher(stt_service)